@@ -1,38 +1,69 @@
 import json
-import io
 import os
+import functools
 import sys
 import pathlib
 import subprocess
 import asyncio
-from typing import Optional, NamedTuple, Any, Awaitable, Dict
+import logging
+import dataclasses
+from typing import Optional, Any, Awaitable, Dict, List, Tuple
+
+log = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    json_loads = json.loads
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
     import signal
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+# StreamReader buffer size. large variables responses fit in one chunk
+READER_LIMIT = 1 << 20
+
 
+@functools.lru_cache(None)
 def get_extensions_path():
     home = pathlib.Path(os.environ['USERPROFILE'])
     return home / '.vscode/extensions'
 
 
+EXTENSION_PREFIXES = ('ms-python.python-', 'webfreak.debug-', 'ms-vscode.go-')
+
+
+@functools.lru_cache(None)
+def get_extensions() -> Dict[str, pathlib.Path]:
+    '''
+    scan extensions folder once. prefix => first matched extension folder
+    '''
+    extensions = {}
+    with os.scandir(get_extensions_path()) as it:
+        for e in it:
+            for prefix in EXTENSION_PREFIXES:
+                if prefix not in extensions and e.name.startswith(prefix):
+                    extensions[prefix] = pathlib.Path(e.path)
+    return extensions
+
+
 def get_python_adapter() -> Optional[pathlib.Path]:
-    extensions = get_extensions_path()
-    extension = next(
-        iter((f for f in extensions.iterdir()
-              if f.name.startswith('ms-python.python-'))))
+    extension = get_extensions()['ms-python.python-']
     main = extension / 'out/client/debugger/debugAdapter/main.js'
     if main.exists():
         return 'node', [str(main)]
 
 
 def get_lldb_adapter() -> Optional[pathlib.Path]:
-    extensions = get_extensions_path()
-    extension = next(
-        iter((f for f in extensions.iterdir()
-              if f.name.startswith('webfreak.debug-'))))
+    extension = get_extensions()['webfreak.debug-']
     main = extension / 'out/src/lldb.js'
 
     if main.exists():
@@ -40,10 +71,7 @@ def get_lldb_adapter() -> Optional[pathlib.Path]:
 
 
 def get_gdb_adapter() -> Optional[pathlib.Path]:
-    extensions = get_extensions_path()
-    extension = next(
-        iter((f for f in extensions.iterdir()
-              if f.name.startswith('webfreak.debug-'))))
+    extension = get_extensions()['webfreak.debug-']
     main = extension / 'out/src/gdb.js'
 
     if main.exists():
@@ -51,10 +79,7 @@ def get_gdb_adapter() -> Optional[pathlib.Path]:
 
 
 def get_go_adapter() -> Optional[pathlib.Path]:
-    extensions = get_extensions_path()
-    extension = next(
-        iter((f for f in extensions.iterdir()
-              if f.name.startswith('ms-vscode.go-'))))
+    extension = get_extensions()['ms-vscode.go-']
     main = extension / 'out\src\debugAdapter\goDebug.js'
     if main.exists():
         return 'node', [str(main)]
@@ -64,25 +89,76 @@ def get_adapter(kind):
     return globals()[f'get_{kind}_adapter']()
 
 
-class Request(NamedTuple):
+# shared arguments for the fixed requests. never mutate
+INITIALIZE_ARGUMENTS = {
+    'pathFormat': 'path',
+}
+EMPTY_ARGUMENTS = {}
+
+# seq is written space padded to this width into pre-serialized requests
+SEQ_WIDTH = 8
+SEQ_LIMIT = 10**SEQ_WIDTH
+
+
+def build_request_template(command: str, arguments) -> Tuple[bytes, bytes]:
+    '''
+    serialize a request with fixed arguments once.
+    return (header + body before seq, body after seq)
+    '''
+    body = json_dumps({
+        'seq': 0,
+        'type': 'request',
+        'command': command,
+        'arguments': arguments,
+    })
+    # skip optional space after the colon (stdlib json)
+    pos = body.index(b'0', body.index(b'"seq":'))
+    size = len(body) - 1 + SEQ_WIDTH
+    head = b'Content-Length: %d\r\n\r\n%s' % (size, body[:pos])
+    return head, body[pos + 1:]
+
+
+# command => (arguments, head, tail)
+REQUEST_TEMPLATES = {
+    command: (arguments, *build_request_template(command, arguments))
+    for command, arguments in (
+        ('initialize', INITIALIZE_ARGUMENTS),
+        ('configurationDone', EMPTY_ARGUMENTS),
+        ('terminate', EMPTY_ARGUMENTS),
+        ('disconnect', EMPTY_ARGUMENTS),
+    )
+}
+
+
+@dataclasses.dataclass(slots=True)
+class Request:
     seq: int
     type: str
     command: str
     arguments: Any = None
 
     def to_bytes(self) -> bytes:
-        body = json.dumps(self._asdict()).encode('utf-8')
-        with io.BytesIO() as f:
-            f.write(f'Content-Length: {len(body)}\r\n'.encode('ascii'))
-            f.write(b'\r\n')
-            f.write(body)
-            return f.getvalue()
+        template = REQUEST_TEMPLATES.get(self.command)
+        if (template and template[0] is self.arguments
+                and self.type == 'request' and self.seq < SEQ_LIMIT):
+            # JSON allows whitespace before a number
+            _, head, tail = template
+            return b'%s%*d%s' % (head, SEQ_WIDTH, self.seq, tail)
+
+        body = json_dumps({
+            'seq': self.seq,
+            'type': self.type,
+            'command': self.command,
+            'arguments': self.arguments,
+        })
+        return b'Content-Length: %d\r\n\r\n%s' % (len(body), body)
 
     def __str__(self) -> str:
         return f'<=={self.seq}: {self.command}'
 
 
-class Response(NamedTuple):
+@dataclasses.dataclass(slots=True)
+class Response:
     seq: int
     type: str
     request_seq: int
@@ -98,7 +174,8 @@ class Response(NamedTuple):
         return f'==>{self.request_seq}: {self.command}, {self.success}{j}'
 
 
-class Event(NamedTuple):
+@dataclasses.dataclass(slots=True)
+class Event:
     seq: int
     type: str
     event: str
@@ -108,67 +185,162 @@ class Event(NamedTuple):
         return f'-->E: {self.event}'
 
 
+MESSAGE_TYPES = {
+    'response': Response,
+    'event': Event,
+}
+
+
+def parse_content_length(buf, end: int) -> int:
+    '''
+    buf[:end] is the header without the terminating blank line
+    '''
+    if buf.startswith(b'Content-Length:'):
+        try:
+            # usual case. the only header
+            return int(buf[15:end])
+        except ValueError:
+            pass
+    start = buf.find(b'Content-Length:', 0, end)
+    if start < 0:
+        return 0
+    line_end = buf.find(b'\r\n', start, end)
+    if line_end < 0:
+        line_end = end
+    return int(buf[start + 15:line_end])
+
+
+def take_buffered(r: asyncio.StreamReader, start: int, end: int) -> bytes:
+    '''
+    consume r._buffer[:end] and return [start:end], without await.
+    the only place touching StreamReader internals for that
+    '''
+    buf = r._buffer
+    data = bytes(buf[start:end])
+    del buf[:end]
+    r._maybe_resume_transport()
+    return data
+
+
 async def read(dap, r: asyncio.StreamReader) -> Awaitable[Response]:
-    size = 0
     # header
-    while True:
-        l = await r.readline()
-        if not l:
-            print('==>EOF')
+    try:
+        header = await r.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        log.debug('==>EOF')
+        return None
+    size = parse_content_length(header, len(header) - 4)
+
+    if size <= len(r._buffer):
+        # body already arrived with the header
+        body = take_buffered(r, 0, size)
+    else:
+        try:
+            body = await r.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            log.warning('==>EOF: %d/%d bytes of body', len(e.partial), size)
             return None
-        if l == b'\r\n':
-            break
-        if l.startswith(b'Content-Length:'):
-            size = int(l[15:].strip())
 
-    body = await r.read(size)
+    return parse(body)
+
+
+def read_buffered(r: asyncio.StreamReader) -> Optional[Response]:
+    '''
+    parse a message already whole in the StreamReader buffer, without await.
+    return None if more bytes are needed.
+    '''
+    buf = r._buffer
+    end = buf.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+    size = parse_content_length(buf, end)
+    body_start = end + 4
+    if len(buf) < body_start + size:
+        return None
+
+    return parse(take_buffered(r, body_start, body_start + size))
 
-    obj = json.loads(body)
+
+def parse(body: bytes):
+    obj = json_loads(body)
 
     t = obj['type']
-    if t == 'response':
-        return Response(**obj)
-    elif t == 'event':
-        return Event(**obj)
-    else:
+    cls = MESSAGE_TYPES.get(t)
+    if not cls:
         raise RuntimeError(f'unknown type: {t}')
+    return cls(**obj)
+
+
+# max pending requests. must be power of 2
+REQUEST_RING_SIZE = 1024
+REQUEST_RING_MASK = REQUEST_RING_SIZE - 1
 
 
 class DAP:
     def __init__(self, r: asyncio.StreamReader, w: asyncio.StreamWriter,
                  config):
         self.next_seq = 1
-        self.request_map: Dict[int, Request] = {}
+        # pending (seq, future) indexed by seq & REQUEST_RING_MASK
+        self.request_ring: List[Optional[Tuple[int, asyncio.Future]]] = [
+            None
+        ] * REQUEST_RING_SIZE
         self.event_map: Dict[str, Event] = {}
         self.w = w
+        self._loop = asyncio.get_running_loop()
         self.config = config
         # schedule infinite StreamReader
-        asyncio.create_task(self._reader(r))
+        self.reader_task = asyncio.create_task(self._reader(r))
 
     async def _reader(self, r: asyncio.StreamReader):
-        while True:
-            res = await read(self, r)
-            if not res:
-                break
-
-            # dispatch response
-            if isinstance(res, Response):
-                print(res)
-                req_fut = self.request_map.get(res.request_seq)
-                if req_fut:
-                    req_fut.set_result(res)
-                else:
-                    raise RuntimeError(f'request: {res.request_seq} not found')
-            elif isinstance(res, Event):
-                print(res)
-                event_fut = self.event_map.get(res.event)
-                if event_fut:
-                    event_fut.set_result(res)
-                else:
-                    # do nothing
-                    pass
-            else:
-                raise RuntimeError(f'unknown: {res}')
+        dispatch = self.DISPATCH
+        try:
+            while True:
+                res = await read(self, r)
+                if not res:
+                    break
+                dispatch[type(res)](self, res)
+
+                # dispatch messages already buffered before yielding
+                while True:
+                    res = read_buffered(r)
+                    if not res:
+                        break
+                    dispatch[type(res)](self, res)
+        finally:
+            # no more responses. do not leave requests waiting forever
+            for pending in self.request_ring:
+                if pending and not pending[1].done():
+                    pending[1].set_exception(
+                        EOFError(f'request: {pending[0]} no response'))
+
+    def _dispatch_response(self, res: Response):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s', res)
+        index = res.request_seq & REQUEST_RING_MASK
+        pending = self.request_ring[index]
+        if pending and pending[0] == res.request_seq:
+            self.request_ring[index] = None
+            if not pending[1].done():
+                pending[1].set_result(res)
+        else:
+            # cancelled request, or unknown seq
+            log.warning('request: %d not found. drop response',
+                        res.request_seq)
+
+    def _dispatch_event(self, res: Event):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s', res)
+        event_fut = self.event_map.get(res.event)
+        if event_fut:
+            event_fut.set_result(res)
+        else:
+            # do nothing
+            pass
+
+    DISPATCH = {
+        Response: _dispatch_response,
+        Event: _dispatch_event,
+    }
 
     def _create_request(self, command, args) -> Request:
         seq = self.next_seq
@@ -176,13 +348,11 @@ class DAP:
         return Request(seq, 'request', command, args)
 
     def _create_initialize_request(self) -> Request:
-        req = self._create_request('initialize', {
-            'pathFormat': 'path',
-        })
+        req = self._create_request('initialize', INITIALIZE_ARGUMENTS)
         return req
 
     def _create_configuration_done_request(self) -> Request:
-        req = self._create_request('configurationDone', {})
+        req = self._create_request('configurationDone', EMPTY_ARGUMENTS)
         return req
 
     def _create_launch_request(self) -> Request:
@@ -190,23 +360,33 @@ class DAP:
         return req
 
     def _create_terminate_request(self) -> Request:
-        req = self._create_request('terminate', {})
+        req = self._create_request('terminate', EMPTY_ARGUMENTS)
         return req
 
     def _create_disconnect_request(self) -> Request:
-        req = self._create_request('disconnect', {})
+        req = self._create_request('disconnect', EMPTY_ARGUMENTS)
         return req
 
     async def _send_request(self, req):
-        print(req)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s', req)
 
         # Create a new Future object.
-        loop = asyncio.get_event_loop()
-        fut = loop.create_future()
-        self.request_map[req.seq] = fut
-
-        self.w.write(req.to_bytes())
-        res = await fut
+        fut = self._loop.create_future()
+        index = req.seq & REQUEST_RING_MASK
+        if self.request_ring[index]:
+            raise RuntimeError(f'too many pending requests: {req.seq}')
+        pending = (req.seq, fut)
+        self.request_ring[index] = pending
+
+        try:
+            self.w.write(req.to_bytes())
+            await self.w.drain()
+            res = await fut
+        finally:
+            # also on cancel. keep the slot if already reused
+            if self.request_ring[index] is pending:
+                self.request_ring[index] = None
 
         return res
 
@@ -237,13 +417,36 @@ class DAP:
         return await self._send_request(self._create_disconnect_request())
 
 
+def log_stderr(buf: bytearray, end: Optional[int] = None):
+    '''
+    log buf[:end] line by line
+    '''
+    if log.isEnabledFor(logging.WARNING):
+        text = buf[:end].decode('utf-8', errors='replace')
+        for l in text.splitlines():
+            log.warning('stderr: %s', l)
+
+
 async def error_reader(r: asyncio.StreamReader):
+    buf = bytearray()
     while True:
-        b = await r.readline()
+        try:
+            # wait for the rest of a partial line at most 0.1 sec
+            b = await asyncio.wait_for(r.read(8192), 0.1 if buf else None)
+        except asyncio.TimeoutError:
+            log_stderr(buf)
+            buf.clear()
+            continue
         if not b:
-            print('stderr: break')
+            if buf:
+                log_stderr(buf)
+            log.debug('stderr: break')
             break
-        print(b'stderr:' + b)
+        buf += b
+        end = buf.rfind(b'\n')
+        if end >= 0:
+            log_stderr(buf, end + 1)
+            del buf[:end + 1]
 
 
 class Launcher:
@@ -252,28 +455,45 @@ class Launcher:
         self.args = args
         self.kw = kw
         self.p = None
+        self.dap = None
+        self.error_task = None
 
     async def __aenter__(self):
         # create process
-        print(self.cmd, *self.args)
+        log.info('%s %s', self.cmd, ' '.join(self.args))
         self.p = await asyncio.create_subprocess_exec(self.cmd,
                                                       *self.args,
                                                       stdout=subprocess.PIPE,
                                                       stderr=subprocess.PIPE,
-                                                      stdin=subprocess.PIPE)
-        print(self.p)
+                                                      stdin=subprocess.PIPE,
+                                                      limit=READER_LIMIT)
+        log.info('%s', self.p)
 
         # scheduled infinite error read
-        asyncio.create_task(error_reader(self.p.stderr))
+        self.error_task = asyncio.create_task(error_reader(self.p.stderr))
 
-        return DAP(self.p.stdout, self.p.stdin, self.kw)
+        self.dap = DAP(self.p.stdout, self.p.stdin, self.kw)
+        return self.dap
 
     async def __aexit__(self, exc_type, exc, tb):
-        print('<==close')
+        log.info('<==close')
         self.p.stdin.close()
         # wait until process terminated
         ret = await self.p.wait()
-        print(f'terminated: {ret}')
+        log.info('terminated: %s', ret)
+
+        # a grandchild may still hold the pipes open.
+        # do not leave the readers to the next session on the same loop
+        tasks = [self.dap.reader_task, self.error_task]
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for task, result in zip(tasks, results):
+            if isinstance(result, BaseException) and not isinstance(
+                    result, asyncio.CancelledError):
+                log.error('%s failed',
+                          task.get_coro().__qualname__,
+                          exc_info=result)
 
 
 async def debug_session(kw) -> None:
@@ -292,7 +512,18 @@ async def debug_session(kw) -> None:
         await dap.disconnect()
 
 
+def run_all(*launches) -> None:
+    '''
+    run debug sessions one after another on a single event loop
+    '''
+    with asyncio.Runner() as runner:
+        for kw in launches:
+            runner.run(debug_session(kw))
+
+
 if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s')
+    log.setLevel(logging.DEBUG)
     here = pathlib.Path(__file__).resolve().parent
 
     python_launch = {
@@ -302,4 +533,4 @@ if __name__ == '__main__':
         'program': str(here / 'sample.py'),
         'console': 'integratedTerminal'
     }
-    asyncio.run(debug_session(python_launch))
+    run_all(python_launch)